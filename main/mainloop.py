@@ -32,8 +32,12 @@
 #
 """MicroPython MainLoop for USMART Sensor Application."""
 
+import array
+import gc
 import pyb
 import machine
+import sys
+import uos
 import utime
 
 from pybd_expansion.main.max3221e import MAX3221E
@@ -47,9 +51,25 @@ from uac_network.main.hudson_sensor_node_network import HudsonSensorNodeNetwork
 import jotter
 
 import micropython
+from micropython import const
 micropython.alloc_emergency_exception_buf(100)
 # https://docs.micropython.org/en/latest/reference/isr_rules.html#the-emergency-exception-buffer
 
+try:
+    import stm  # STM32 register access - used to switch the peripheral power pins with a single register write
+except ImportError:
+    stm = None
+
+
+_RESET_CAUSE_NAMES = {
+    machine.PWRON_RESET: "PWRON_RESET",
+    machine.HARD_RESET: "HARD_RESET",
+    machine.WDT_RESET: "WDT_RESET",
+    machine.DEEPSLEEP_RESET: "DEEPSLEEP_RESET",
+    machine.SOFT_RESET: "SOFT_RESET",
+}
+
+_GC_FREE_THRESHOLD = const(8192)  # only collect around network packets when free heap drops below this
 
 _env_variables = None
 _rtc_callback_flag = False
@@ -97,24 +117,65 @@ def rtc_callback(unknown):
 
 
 _nm3_callback_flag = False
-_nm3_callback_seconds = 0  # used with utime.localtime(_nm3_callback_seconds) to make a timestamp
-_nm3_callback_millis = 0  # loops after 12.4 days. pauses during sleep modes.
-_nm3_callback_micros = 0  # loops after 17.8 minutes. pauses during sleep modes.
+# HW triggered timestamps. Written in place by nm3_callback so the interrupt handler does not allocate.
+_NM3_CALLBACK_SECONDS = const(0)  # used with utime.localtime() to make a timestamp
+_NM3_CALLBACK_MILLIS = const(1)  # loops after 12.4 days. pauses during sleep modes.
+_NM3_CALLBACK_MICROS = const(2)  # loops after 17.8 minutes. pauses during sleep modes.
+_NM3_CALLBACK_TICKS_MS = const(3)  # utime.ticks_ms() for overflow safe ticks_diff. pauses during sleep modes.
+# Signed 32-bit so the sign-extended micros/millis round-trip unchanged as small ints once they wrap negative.
+_nm3_callback_timestamps = array.array('i', [0, 0, 0, 0])
 
+# Stay awake polling for messages for this long after the last NM3 synch.
+_NM3_SYNCH_WINDOW_MS = const(30000)
 
-def nm3_callback(line):
+
+@micropython.native
+def nm3_callback(line, timestamps=_nm3_callback_timestamps):
     # NB: You cannot do anything that allocates memory in this interrupt handler.
+    # pyb.ExtInt callbacks are hard IRQs. The timestamps array is bound as a default argument to avoid a global lookup.
     global _nm3_callback_flag
-    global _nm3_callback_seconds
-    global _nm3_callback_millis
-    global _nm3_callback_micros
     # NM3 Callback function
-    _nm3_callback_micros = pyb.micros()
-    _nm3_callback_millis = pyb.millis()
-    _nm3_callback_seconds = utime.time()
+    timestamps[_NM3_CALLBACK_MICROS] = pyb.micros()
+    timestamps[_NM3_CALLBACK_MILLIS] = pyb.millis()
+    timestamps[_NM3_CALLBACK_SECONDS] = utime.time()
+    timestamps[_NM3_CALLBACK_TICKS_MS] = utime.ticks_ms()
     _nm3_callback_flag = True
 
 
+# Alive message templates: UA<address>B<battery>V<revision>. The digits are written in place on each send.
+# Plus a version/date so we can determine if an OTA update has worked
+_ALIVE_REVISION = b"REV:2021-07-09T17:38:00"
+_ALIVE_ADDRESS_POS = const(2)
+_ALIVE_VOLTAGE_POS = const(6)
+_alive_message_1v = bytearray(b"UA000B0.00V" + _ALIVE_REVISION)  # battery below 10V
+_alive_message_2v = bytearray(b"UA000B00.00V" + _ALIVE_REVISION)  # battery 10V and above
+
+
+@micropython.viper
+def _fmt_u3(buf: ptr8, pos: int, n: int):
+    """Write n as three ASCII digits into buf at pos. n must be 0-999 - no sign or range checking is done here."""
+    buf[pos] = 0x30 + (n // 100) % 10
+    buf[pos + 1] = 0x30 + (n // 10) % 10
+    buf[pos + 2] = 0x30 + n % 10
+
+
+@micropython.viper
+def _fmt_fixed2(buf: ptr8, pos: int, n: int, int_digits: int):
+    """Write n hundredths as int_digits.dd ASCII into buf at pos. The '.' is already in the template.
+
+    n must be non-negative and fit in int_digits - negative values are silently wrapped into digits by the floor %.
+    """
+    buf[pos + int_digits + 2] = 0x30 + n % 10
+    n = n // 10
+    buf[pos + int_digits + 1] = 0x30 + n % 10
+    n = n // 10
+    i = pos + int_digits - 1
+    while i >= pos:
+        buf[i] = 0x30 + n % 10
+        n = n // 10
+        i -= 1
+
+
 def send_usmart_alive_message(modem):
     # Send a standard broadcast Alive message. Usually called on startup and on request by external message.
     # Grab address and voltage from the modem
@@ -127,16 +188,325 @@ def send_usmart_alive_message(modem):
         # jotter.get_jotter().jot("NM3 Address {:03d} Voltage {:0.2f}V.".format(nm3_address, nm3_voltage),
         #                        source_file=__name__)
         # So here we will broadcast an I'm Alive message. Payload: U (for USMART), A (for Alive), Address, B, Battery
-        # Plus a version/date so we can determine if an OTA update has worked
-        alive_string = "UA" + "{:03d}".format(nm3_address) + "B{:0.2f}V".format(nm3_voltage) + "REV:2021-07-09T17:38:00"
-        modem.send_broadcast_message(alive_string.encode('utf-8'))
+        # Fill in the preallocated template rather than building and encoding strings.
+        centivolts = int(round(nm3_voltage, 2) * 100 + 0.5)  # round() first to match the '{:0.2f}' rounding
+        # Range check before the viper digit writers, which assume non-negative values that fit the template.
+        if not (0 <= nm3_address <= 999 and 0 <= centivolts < 10000):
+            # Out of template range - e.g. the driver's -1 on a failed read. Send it as is so the fault is visible.
+            alive_string = "UA" + "{:03d}".format(nm3_address) + "B{:0.2f}V".format(nm3_voltage) \
+                           + _ALIVE_REVISION.decode('utf-8')
+            modem.send_broadcast_message(alive_string.encode('utf-8'))
+            return
+
+        if centivolts < 1000:
+            alive_message = _alive_message_1v
+            _fmt_fixed2(alive_message, _ALIVE_VOLTAGE_POS, centivolts, 1)
+        else:
+            alive_message = _alive_message_2v
+            _fmt_fixed2(alive_message, _ALIVE_VOLTAGE_POS, centivolts, 2)
+        _fmt_u3(alive_message, _ALIVE_ADDRESS_POS, nm3_address)
+        modem.send_broadcast_message(alive_message)
+
+
+def _handle_usmrt(modem, wdt):
+    # print("Reset message received.")
+    _jot("Reset message received.", source_file=__name__)
+    # Reset the device
+    machine.reset()
+
+
+def _handle_usota(modem, wdt):
+    # print("OTA message received.")
+    _jot("OTA message received.", source_file=__name__)
+    # Write a special flag file to tell us to OTA on reset
+    try:
+        # Binary mode - an empty file needs no text wrapper.
+        with open('.USOTA', 'wb') as otaflagfile:
+            # otaflagfile.write(latest_version)
+            pass
+        # Flush the filesystem so the flag file survives the reset that follows.
+        uos.sync()
+    except Exception as the_exception:
+        _log_exception(the_exception)
+        pass
+
+    # Reset the device
+    machine.reset()
+
+
+def _handle_uspng(modem, wdt):
+    # print("PNG message received.")
+    _jot("PNG message received.", source_file=__name__)
+    send_usmart_alive_message(modem)
+
+
+_mod_payloads = None  # cached UM packets for the USMOD response, built on first request
+
+
+def _handle_usmod(modem, wdt):
+    global _mod_payloads
+    # print("MOD message received.")
+    _jot("MOD message received.", source_file=__name__)
+    # Send the installed modules list as single packets with 1 second delay between each -
+    # Only want to be calling this after doing an OTA command and ideally not in the sea.
+
+    # The address and installed modules do not change at runtime so build the packets once.
+    mod_payloads = _mod_payloads
+    if mod_payloads is None:
+        mod_payloads = []
+        nm3_address = modem.get_address()
+
+        if _env_variables and "installedModules" in _env_variables:
+            installed_modules = _env_variables["installedModules"]
+            if installed_modules:
+                for (mod, version) in installed_modules.items():
+                    mod_string = "UM{:03d}:{}:{}".format(nm3_address, mod, version if version else "None")
+                    mod_payloads.append(mod_string.encode('utf-8'))
+
+        # Only cache a complete list built from a valid address. A failed read (-1) is retried on the next USMOD.
+        if nm3_address >= 0:
+            _mod_payloads = mod_payloads
+
+    for mod_payload in mod_payloads:
+        modem.send_broadcast_message(mod_payload)
+
+        # delay whilst sending
+        utime.sleep_ms(1000)
+
+        # Feed the watchdog
+        wdt.feed()
+
+
+# Special US packets - a single hashed lookup per received packet rather than a chain of comparisons.
+_US_COMMAND_LENGTH = 5
+_us_command_handlers = {
+    b'USMRT': _handle_usmrt,
+    b'USOTA': _handle_usota,
+    b'USPNG': _handle_uspng,
+    b'USMOD': _handle_usmod,
+}
+
+
+_peripheral_power_on = False  # tracks EN_3V3 and the MAX3221E Tx driver so redundant pin writes are skipped
+_pullups_enabled = None  # unknown until first set
+
+# Off by default: the fast path bypasses MAX3221E.tx_force_on/off() and assumes the driver only drives its enable pin
+# high/low with no other side effects. Enable with set_gpio_bsrr_enabled() once confirmed against pybd_expansion.
+_gpio_bsrr_enabled = False
+_power_gpio_bsrr_on = ()  # ((BSRR address, set mask), ...) in power on order. Built by _init_power_gpio().
+_power_gpio_bsrr_off = ()  # ((BSRR address, reset mask), ...) in power off order - the reverse of power on.
+
+
+def _init_power_gpio(pins):
+    """Precompute the GPIO BSRR writes to switch the given output pins, listed in power on order. STM32 only.
+
+    Consecutive pins on the same GPIO port share one write. Power off applies the writes in reverse order.
+    """
+    global _power_gpio_bsrr_on
+    global _power_gpio_bsrr_off
+    if not _gpio_bsrr_enabled or stm is None or not hasattr(stm, "GPIO_BSRR"):
+        return
+
+    writes = []  # [[BSRR address, set mask], ...]
+    for pin in pins:
+        bsrr_address = pin.gpio() + stm.GPIO_BSRR
+        if writes and writes[-1][0] == bsrr_address:
+            writes[-1][1] |= 1 << pin.pin()
+        else:
+            writes.append([bsrr_address, 1 << pin.pin()])
+
+    # Masks are built here so no large ints are allocated when switching. Reset bits are the upper half of BSRR.
+    _power_gpio_bsrr_on = tuple((address, mask) for (address, mask) in writes)
+    _power_gpio_bsrr_off = tuple((address, mask << 16) for (address, mask) in reversed(writes))
+
+
+def _set_peripheral_power(max3221e, enable):
+    """Switch the 3V3 supply to the 232 driver, sensors and SDCard along with the Tx driver. No-op if unchanged."""
+    global _peripheral_power_on
+    if enable == _peripheral_power_on:
+        return
+
+    if _power_gpio_bsrr_on:
+        # One atomic register write per GPIO port. EN_3V3 before the Tx driver on power on, and the reverse on power off.
+        mem32 = stm.mem32
+        for (bsrr_address, mask) in (_power_gpio_bsrr_on if enable else _power_gpio_bsrr_off):
+            mem32[bsrr_address] = mask
+    elif enable:
+        pyb.Pin.board.EN_3V3.on()
+        max3221e.tx_force_on()  # Enable Tx Driver
+    else:
+        max3221e.tx_force_off()  # Disable Tx Driver
+        pyb.Pin.board.EN_3V3.off()  # except in dev
+
+    _peripheral_power_on = enable
+
+
+def _set_pullups(enable):
+    """Enable or disable the 5.6kOhm I2C pull-ups. The pins are only reconfigured on a change of state."""
+    global _pullups_enabled
+    if enable == _pullups_enabled:
+        return
+
+    if enable:
+        pyb.Pin('PULL_SCL', pyb.Pin.OUT, value=1)  # enable 5.6kOhm X9/SCL pull-up
+        pyb.Pin('PULL_SDA', pyb.Pin.OUT, value=1)  # enable 5.6kOhm X10/SDA pull-up
+    else:
+        pyb.Pin('PULL_SCL', pyb.Pin.IN)  # disable 5.6kOhm X9/SCL pull-up
+        pyb.Pin('PULL_SDA', pyb.Pin.IN)  # disable 5.6kOhm X10/SDA pull-up
+
+    _pullups_enabled = enable
+
+
+def _log_exception(the_exception):
+    """Print and log an exception caught in the mainloop."""
+    sys.print_exception(the_exception)
+    jotter.get_jotter().jot_exception(the_exception)
+
+
+@micropython.native
+def _handle_incoming(nm3_modem, nm3_network, wdt):
+    """Poll the modem and dispatch any received packets. Called whilst within the NM3 synch window."""
+    global _nm3_callback_flag
+
+    jot = _jot
+
+    if _nm3_callback_flag:
+        print("Has received nm3 synch flag.")
+
+    _nm3_callback_flag = False  # clear the flag
+
+    # There may or may not be a message for us. And it could take up to 0.5s to arrive at the uart.
+
+    nm3_modem.poll_receiver()
+    nm3_modem.process_incoming_buffer()
+
+    # Drain the received packets using bound methods held in locals - one attribute lookup each, not per packet.
+    has_received_packet = nm3_modem.has_received_packet
+    get_received_packet = nm3_modem.get_received_packet
+
+    while has_received_packet():
+        # print("Has received nm3 message.")
+        print("Has received nm3 message.")
+        jot("Has received nm3 message.", source_file=__name__)
+
+        message_packet = get_received_packet()
+        # Contain any failure to this packet so the rest of the queue is still drained.
+        try:
+            # Copy the HW triggered timestamps over. The localtime tuple is only built for network packets below.
+            message_packet.timestamp_millis = _nm3_callback_timestamps[_NM3_CALLBACK_MILLIS]
+            message_packet.timestamp_micros = _nm3_callback_timestamps[_NM3_CALLBACK_MICROS]
+
+            payload = message_packet.packet_payload
+
+            # Process special packets US
+            # All US commands are 5 bytes long so only pay for the bytes() copy when the length matches.
+            if payload and len(payload) == _US_COMMAND_LENGTH:
+                handler = _us_command_handlers.get(bytes(payload))
+                if handler:
+                    handler(nm3_modem, wdt)
+
+            # How are HUDSON network messages prefixed to filter from other messages? Is this the '#'?
+
+            # Send on to submodules: Network/Localisation UN/UL
+            # Compare the first byte as an int - no slice or bytes() allocation. Works for bytes, bytearray or a list.
+            if payload and len(payload) > 2 and payload[0] == 0x23:  # '#'
+                # Network Packet
+                message_packet.timestamp = utime.localtime(_nm3_callback_timestamps[_NM3_CALLBACK_SECONDS])
+
+                # Wrap with garbage collection to tidy up memory usage. Only pay for a full heap walk
+                # when free memory is actually running low.
+                if gc.mem_free() < _GC_FREE_THRESHOLD:
+                    gc.collect()
+                # Call Mauro's Network Module here and provide the packet
+                nm3_network.handle_packet(message_packet)
+                if gc.mem_free() < _GC_FREE_THRESHOLD:
+                    gc.collect()
+
+                pass  # End of Network Packets
+        except Exception as the_exception:
+            _log_exception(the_exception)
+
+
+@micropython.native
+def _sleep_until_flag(wdt, max3221e):
+    """Power down the peripherals and lightsleep until the RTC or NM3 callback sets its flag. Powers back up."""
+    # Local aliases for the sleep spin below.
+    wdt_feed = wdt.feed
+    lightsleep = machine.lightsleep
+    disable_irq = machine.disable_irq
+    enable_irq = machine.enable_irq
+
+    # Double check the flags before powering things off
+    if (not _rtc_callback_flag) and (not _nm3_callback_flag):
+        print("Going to sleep.")
+        _jot("Going to sleep.", source_file=__name__)
+
+        # Disable the I2C pullups
+        _set_pullups(False)
+        # Disable power supply to 232 driver, sensors, and SDCard
+        _set_peripheral_power(max3221e, False)
+        pyb.LED(2).off()  # Asleep
+        utime.sleep_ms(10)
+
+    while (not _rtc_callback_flag) and (not _nm3_callback_flag):
+        # Feed the watchdog
+        wdt_feed()
+        # Now wait
+        #utime.sleep_ms(100)
+        # pyb.wfi()  # wait-for-interrupt (can be ours or the system tick every 1ms or anything else)
+        # lightsleep - don't use the time as this then overrides the RTC. machine.lightsleep(ms) also
+        # disables the RTC wakeup on return, which would stop the 10 second watchdog feed.
+        # Check the flags and enter lightsleep with IRQs disabled so an edge arriving between the check
+        # and the sleep is not missed until the next RTC wakeup. A pending IRQ still wakes the core and
+        # the callback runs as soon as IRQs are re-enabled.
+        # The finally ensures IRQs are always restored - otherwise the flags could never be set again whilst the
+        # loop keeps feeding the watchdog.
+        irq_state = disable_irq()
+        try:
+            if (not _rtc_callback_flag) and (not _nm3_callback_flag):
+                lightsleep()
+        finally:
+            enable_irq(irq_state)
+
+    # Wake-up
+    # pyb.LED(2).on()  # Awake
+    # Feed the watchdog
+    wdt_feed()
+    # Enable power supply to 232 driver, sensors, and SDCard
+    _set_peripheral_power(max3221e, True)
+    # Enable the I2C pullups
+    _set_pullups(True)
 
 
 # - def set_environment_variables()
 def set_environment_variables(env_variables_dict=None):
     """Set a global dictionary of variables."""
     global _env_variables
+    global _mod_payloads
     _env_variables = env_variables_dict
+    _mod_payloads = None  # rebuild from the new installedModules on the next USMOD
+
+
+_jot_enabled = True
+_jot = None  # bound by run_mainloop() to either the jotter's jot method or _jot_disabled
+
+
+def _jot_disabled(message, source_file=None):
+    pass
+
+
+# - def set_jot_enabled()
+def set_jot_enabled(enabled=True):
+    """Enable or disable jotter logging from the mainloop. Call before run_mainloop()."""
+    global _jot_enabled
+    _jot_enabled = enabled
+
+
+# - def set_gpio_bsrr_enabled()
+def set_gpio_bsrr_enabled(enabled=True):
+    """Switch EN_3V3 and the MAX3221E enable pin with direct GPIO BSRR writes on STM32. Call before run_mainloop()."""
+    global _gpio_bsrr_enabled
+    _gpio_bsrr_enabled = enabled
 
 
 # Standard Interface for MainLoop
@@ -145,34 +515,25 @@ def run_mainloop():
     """Standard Interface for MainLoop. Never returns."""
 
     global _env_variables
+    global _jot
+    global _peripheral_power_on
     global _rtc_callback_flag
     global _rtc_callback_seconds
     global _nm3_callback_flag
-    global _nm3_callback_seconds
-    global _nm3_callback_millis
-    global _nm3_callback_micros
 
     # Firstly Initialise the Watchdog machine.WDT. This cannot now be stopped and *must* be fed.
     wdt = machine.WDT(timeout=30000)  # 30 seconds timeout on the watchdog.
 
     # Now if anything causes us to crashout from here we will reboot automatically.
 
+    # Bind the jot function once. When disabled the no-op is called instead and no log strings are built.
+    _jot = jotter.get_jotter().jot if _jot_enabled else _jot_disabled
+
     # Last reset cause
-    last_reset_cause = "PWRON_RESET"
-    if machine.reset_cause() == machine.PWRON_RESET:
-        last_reset_cause = "PWRON_RESET"
-    elif machine.reset_cause() == machine.HARD_RESET:
-        last_reset_cause = "HARD_RESET"
-    elif machine.reset_cause() == machine.WDT_RESET:
-        last_reset_cause = "WDT_RESET"
-    elif machine.reset_cause() == machine.DEEPSLEEP_RESET:
-        last_reset_cause = "DEEPSLEEP_RESET"
-    elif machine.reset_cause() == machine.SOFT_RESET:
-        last_reset_cause = "SOFT_RESET"
-    else:
-        last_reset_cause = "UNDEFINED_RESET"
+    last_reset_cause = _RESET_CAUSE_NAMES.get(machine.reset_cause(), "UNDEFINED_RESET")
 
-    jotter.get_jotter().jot("Reset cause: " + last_reset_cause, source_file=__name__)
+    if _jot_enabled:
+        _jot("Reset cause: " + last_reset_cause, source_file=__name__)
 
     print("last_reset_cause=" + last_reset_cause)
 
@@ -183,6 +544,9 @@ def run_mainloop():
     # Set RTC to wakeup at a set interval
     rtc = pyb.RTC()
     rtc.init()  # reinitialise - there were bugs in firmware. This wipes the datetime.
+    # No synch yet - open the window from here, as the wiped datetime did when compared against a zero timestamp.
+    # Startup takes ~20s so the loop polls for the remaining ~10s before its first sleep.
+    _nm3_callback_timestamps[_NM3_CALLBACK_TICKS_MS] = utime.ticks_ms()
     # A default wakeup to start with. To be overridden by network manager/sleep manager
     rtc.wakeup(10 * 1000, rtc_callback)  # milliseconds - # Every 10 seconds - needed to feed the watchdog
 
@@ -192,7 +556,7 @@ def run_mainloop():
 
     pyb.LED(2).on()  # Green LED On
 
-    jotter.get_jotter().jot("Powering off NM3", source_file=__name__)
+    _jot("Powering off NM3", source_file=__name__)
 
     # Cycle the NM3 power supply on the powermodule
     powermodule = PowerModule()
@@ -203,11 +567,17 @@ def run_mainloop():
     pyb.Pin('Y5', pyb.Pin.OUT, value=0)  # enable Y5 Pin as output
     max3221e = MAX3221E(pyb.Pin.board.Y5)
     max3221e.tx_force_on()  # Enable Tx Driver
+    _peripheral_power_on = True
+    # Power on order: EN_3V3 then the MAX3221E enable pin (Y5). Only used when set_gpio_bsrr_enabled() was called.
+    _init_power_gpio((pyb.Pin.board.EN_3V3, pyb.Pin.board.Y5))
 
     # Set callback for nm3 pin change - line goes high on frame synchronisation
-    # make sure it is clear first
-    nm3_extint = pyb.ExtInt(pyb.Pin.board.Y3, pyb.ExtInt.IRQ_RISING, pyb.Pin.PULL_DOWN, None)
+    # A single ExtInt - the line is briefly disabled to discard any spurious edge whilst being configured.
     nm3_extint = pyb.ExtInt(pyb.Pin.board.Y3, pyb.ExtInt.IRQ_RISING, pyb.Pin.PULL_DOWN, nm3_callback)
+    nm3_extint.disable()
+    utime.sleep_ms(1)
+    _nm3_callback_flag = False
+    nm3_extint.enable()
 
     # Serial Port/UART is opened with a 100ms timeout for reading - non-blocking.
     # UART is opened before powering up NM3 to ensure legal state of Tx pin.
@@ -218,7 +588,7 @@ def run_mainloop():
     # Feed the watchdog
     wdt.feed()
 
-    jotter.get_jotter().jot("Powering on NM3", source_file=__name__)
+    _jot("Powering on NM3", source_file=__name__)
 
     utime.sleep_ms(10000)
     powermodule.enable_nm3()
@@ -227,7 +597,7 @@ def run_mainloop():
     # Feed the watchdog
     wdt.feed()
 
-    jotter.get_jotter().jot("NM3 running", source_file=__name__)
+    _jot("NM3 running", source_file=__name__)
 
 
     # Grab address and voltage from the modem
@@ -236,8 +606,8 @@ def run_mainloop():
     nm3_voltage = nm3_modem.get_battery_voltage()
     utime.sleep_ms(20)
     print("NM3 Address {:03d} Voltage {:0.2f}V.".format(nm3_address, nm3_voltage))
-    jotter.get_jotter().jot("NM3 Address {:03d} Voltage {:0.2f}V.".format(nm3_address, nm3_voltage),
-                            source_file=__name__)
+    if _jot_enabled:
+        _jot("NM3 Address {:03d} Voltage {:0.2f}V.".format(nm3_address, nm3_voltage), source_file=__name__)
 
     # Here we will broadcast an I'm Alive message. Payload: U (for USMART), A (for Alive), Address, B, Battery
     # send_usmart_alive_message(nm3_modem)
@@ -262,6 +632,13 @@ def run_mainloop():
     uptime_start = utime.time()
 
 
+    # Local aliases for the loop below - saves a global/attribute lookup on every use.
+    time_s = utime.time
+    ticks_ms = utime.ticks_ms
+    ticks_diff = utime.ticks_diff
+    wdt_feed = wdt.feed
+    jot = _jot
+
     # Operating Mode
     #
     # Note: This application only acts in response to incoming acoustic messages.
@@ -271,156 +648,40 @@ def run_mainloop():
     # The default hourly alarm is not currently used by this application.
 
     while True:
-        try:
-            # Feed the watchdog
-            wdt.feed()
+        # Feed the watchdog
+        wdt_feed()
 
+        # Each phase has its own guard so a failure servicing messages cannot skip the sleep phase or vice versa.
+        try:
             # Enable power supply to 232 driver
-            pyb.Pin.board.EN_3V3.on()
+            _set_peripheral_power(max3221e, True)
 
             # Check for the RTC alarm flag
             if _rtc_callback_flag:
                 _rtc_callback_flag = False  # Clear the flag
-                print("RTC Flag. Nothing to do." + " time now=" + str(utime.time()))
-                jotter.get_jotter().jot("RTC Flag. Nothing to do.", source_file=__name__)
+                print("RTC Flag. Nothing to do." + " time now=" + str(time_s()))
+                jot("RTC Flag. Nothing to do.", source_file=__name__)
                 # We're not using the RTC in this application. But it is needed to ensure the WDT is fed.
                 pass
 
             # If we're within 30 seconds of the last timestamped NM3 synch arrival then poll for messages.
-            if _nm3_callback_flag or (utime.time() < _nm3_callback_seconds + 30):
-                if _nm3_callback_flag:
-                    print("Has received nm3 synch flag.")
-
-                _nm3_callback_flag = False  # clear the flag
-
-                # There may or may not be a message for us. And it could take up to 0.5s to arrive at the uart.
-
-                nm3_modem.poll_receiver()
-                nm3_modem.process_incoming_buffer()
-
-                while nm3_modem.has_received_packet():
-                    # print("Has received nm3 message.")
-                    print("Has received nm3 message.")
-                    jotter.get_jotter().jot("Has received nm3 message.", source_file=__name__)
-
-                    message_packet = nm3_modem.get_received_packet()
-                    # Copy the HW triggered timestamps over
-                    message_packet.timestamp = utime.localtime(_nm3_callback_seconds)
-                    message_packet.timestamp_millis = _nm3_callback_millis
-                    message_packet.timestamp_micros = _nm3_callback_micros
-
-                    # Process special packets US
-                    if message_packet.packet_payload and bytes(message_packet.packet_payload) == b'USMRT':
-                        # print("Reset message received.")
-                        jotter.get_jotter().jot("Reset message received.", source_file=__name__)
-                        # Reset the device
-                        machine.reset()
-
-                    if message_packet.packet_payload and bytes(message_packet.packet_payload) == b'USOTA':
-                        # print("OTA message received.")
-                        jotter.get_jotter().jot("OTA message received.", source_file=__name__)
-                        # Write a special flag file to tell us to OTA on reset
-                        try:
-                            with open('.USOTA', 'w') as otaflagfile:
-                                # otaflagfile.write(latest_version)
-                                otaflagfile.close()
-                        except Exception as the_exception:
-                            jotter.get_jotter().jot_exception(the_exception)
-
-                            import sys
-                            sys.print_exception(the_exception)
-                            pass
-
-                        # Reset the device
-                        machine.reset()
-
-                    if message_packet.packet_payload and bytes(message_packet.packet_payload) == b'USPNG':
-                        # print("PNG message received.")
-                        jotter.get_jotter().jot("PNG message received.", source_file=__name__)
-                        send_usmart_alive_message(nm3_modem)
-
-                    if message_packet.packet_payload and bytes(message_packet.packet_payload) == b'USMOD':
-                        # print("MOD message received.")
-                        jotter.get_jotter().jot("MOD message received.", source_file=__name__)
-                        # Send the installed modules list as single packets with 1 second delay between each -
-                        # Only want to be calling this after doing an OTA command and ideally not in the sea.
-
-                        nm3_address = nm3_modem.get_address()
-
-                        if _env_variables and "installedModules" in _env_variables:
-                            installed_modules = _env_variables["installedModules"]
-                            if installed_modules:
-                                for (mod, version) in installed_modules.items():
-                                    mod_string = "UM" + "{:03d}".format(nm3_address) + ":" + str(mod) + ":" \
-                                                 + str(version if version else "None")
-                                    nm3_modem.send_broadcast_message(mod_string.encode('utf-8'))
-
-                                    # delay whilst sending
-                                    utime.sleep_ms(1000)
-
-                                    # Feed the watchdog
-                                    wdt.feed()
-
-                    # How are HUDSON network messages prefixed to filter from other messages? Is this the '#'?
-
-                    # Send on to submodules: Network/Localisation UN/UL
-                    if message_packet.packet_payload and len(message_packet.packet_payload) > 2 and \
-                            bytes(message_packet.packet_payload[:1]) == b'#':
-                        # Network Packet
-
-                        # Wrap with garbage collection to tidy up memory usage.
-                        import gc
-                        gc.collect()
-                        # Call Mauro's Network Module here and provide the packet
-                        nm3_network.handle_packet(message_packet)
-                        gc.collect()
-
-                        pass  # End of Network Packets
+            if _nm3_callback_flag or \
+                    ticks_diff(ticks_ms(), _nm3_callback_timestamps[_NM3_CALLBACK_TICKS_MS]) < _NM3_SYNCH_WINDOW_MS:
+                _handle_incoming(nm3_modem, nm3_network, wdt)
+
+        except Exception as the_exception:
+            _log_exception(the_exception)
 
+        try:
             # If too long since last synch and no RTC flag
-            if not _rtc_callback_flag and (not _nm3_callback_flag) and (utime.time() > _nm3_callback_seconds + 30):
-
-                # Double check the flags before powering things off
-                if (not _rtc_callback_flag) and (not _nm3_callback_flag):
-                    print("Going to sleep.")
-                    jotter.get_jotter().jot("Going to sleep.", source_file=__name__)
-
-                    # Disable the I2C pullups
-                    pyb.Pin('PULL_SCL', pyb.Pin.IN)  # disable 5.6kOhm X9/SCL pull-up
-                    pyb.Pin('PULL_SDA', pyb.Pin.IN)  # disable 5.6kOhm X10/SDA pull-up
-                    # Disable power supply to 232 driver, sensors, and SDCard
-                    max3221e.tx_force_off()  # Disable Tx Driver
-                    pyb.Pin.board.EN_3V3.off()  # except in dev
-                    pyb.LED(2).off()  # Asleep
-                    utime.sleep_ms(10)
-
-                while (not _rtc_callback_flag) and (not _nm3_callback_flag):
-                    # Feed the watchdog
-                    wdt.feed()
-                    # Now wait
-                    #utime.sleep_ms(100)
-                    # pyb.wfi()  # wait-for-interrupt (can be ours or the system tick every 1ms or anything else)
-                    machine.lightsleep()  # lightsleep - don't use the time as this then overrides the RTC
-
-                # Wake-up
-                # pyb.LED(2).on()  # Awake
-                # Feed the watchdog
-                wdt.feed()
-                # Enable power supply to 232 driver, sensors, and SDCard
-                pyb.Pin.board.EN_3V3.on()
-                max3221e.tx_force_on()  # Enable Tx Driver
-                # Enable the I2C pullups
-                pyb.Pin('PULL_SCL', pyb.Pin.OUT, value=1)  # enable 5.6kOhm X9/SCL pull-up
-                pyb.Pin('PULL_SDA', pyb.Pin.OUT, value=1)  # enable 5.6kOhm X10/SDA pull-up
-
-            pass  # end of operating mode
+            if not _rtc_callback_flag and (not _nm3_callback_flag) and \
+                    ticks_diff(ticks_ms(), _nm3_callback_timestamps[_NM3_CALLBACK_TICKS_MS]) >= _NM3_SYNCH_WINDOW_MS:
+                _sleep_until_flag(wdt, max3221e)
 
         except Exception as the_exception:
-            import sys
-            sys.print_exception(the_exception)
-            jotter.get_jotter().jot_exception(the_exception)
-            pass
-            # Log to file
+            _log_exception(the_exception)
+
+        pass  # end of operating mode
 
     # end of while True
 